@@ -1,5 +1,7 @@
-from six import BytesIO, StringIO, text_type, string_types
+from six import BytesIO, StringIO, text_type, string_types, raise_from
 
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
 from django.http import HttpResponse
 from django.contrib.contenttypes.models import ContentType
 try:
@@ -9,18 +11,31 @@ except ImportError:
     from django.db.models.fields.related import (
         ReverseManyRelatedObjectsDescriptor as ManyToManyDescriptor
     )
-from django.db.models import Avg, Count, Sum, Max, Min
+from django.db.models import Avg, Count, Sum, Max, Min, Q
+try:
+    from django.db.models.query import ValuesListIterable
+except ImportError:
+    # Django 1.8 compat hack.
+    from django.db.models.query import ValuesListQuerySet
+    ValuesListIterable = None
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    from django.db.models.sql.datastructures import EmptyResultSet
 from openpyxl.workbook import Workbook
 from openpyxl.writer.excel import save_virtual_workbook
 from openpyxl.cell import get_column_letter
 from openpyxl.styles import Font
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import csv
+import json
 import re
 from collections import namedtuple
 from decimal import Decimal
 from numbers import Number
 from functools import reduce
 import datetime
+import uuid
 
 from report_utils.model_introspection import (
     get_relation_fields_from_model,
@@ -28,6 +43,7 @@ from report_utils.model_introspection import (
     get_direct_fields_from_model,
     get_model_from_path_string,
     get_custom_fields_from_model,
+    get_custom_value_from_object,
 )
 
 DisplayField = namedtuple(
@@ -35,6 +51,14 @@ DisplayField = namedtuple(
     "path path_verbose field field_verbose aggregate total group choices field_type",
 )
 
+class ReportSheetError(Exception):
+    """ A sheet of reports_to_workbook failed """
+    pass
+
+class ReplicaLagError(Exception):
+    """ The report database is further behind than allowed """
+    pass
+
 def generate_filename(title, ends_with):
     title = title.split('.')[0]
     title.replace(' ', '_')
@@ -43,6 +67,139 @@ def generate_filename(title, ends_with):
         title += ends_with
     return title
 
+def get_replica_lag(using):
+    """ Return replication lag in seconds for database `using`, or None
+    when it is unknown or the database is not a replica.
+    Only PostgreSQL replicas are checked.
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return None
+    if connection.pg_version >= 100000:
+        receive, replay = 'pg_last_wal_receive_lsn', 'pg_last_wal_replay_lsn'
+    else:
+        receive, replay = 'pg_last_xlog_receive_location', 'pg_last_xlog_replay_location'
+    cursor = connection.cursor()
+    try:
+        # The last replay time only says how long ago the primary last
+        # wrote, so a replica that has replayed everything it received is
+        # caught up no matter how old that is.
+        cursor.execute(
+            "SELECT CASE WHEN {0}() = {1}() THEN 0 "
+            "ELSE EXTRACT(EPOCH FROM (now() - pg_last_xact_replay_timestamp())) "
+            "END".format(receive, replay))
+        lag = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+    if lag is None:
+        return None
+    return float(lag)
+
+def get_report_database(using=None):
+    """ Pick the database alias a report should read from.
+
+    Falls back to settings.REPORT_UTILS_DATABASE when `using` is not given.
+    If settings.REPORT_UTILS_REPLICA_MAX_LAG (seconds) is set and the chosen
+    replica is further behind than that, settings.REPORT_UTILS_REPLICA_LAG_FALLBACK
+    decides what happens:
+        'primary' (default): read from the default database instead
+        'replica': read from the lagging replica anyway
+        'raise': raise ReplicaLagError
+    Lag is only measured on PostgreSQL; for other databases the setting is
+    ignored and the chosen alias is always used.
+
+    Returns the alias, or None when no routing was requested, and a message
+    noting any fallback.
+    """
+    if using is None:
+        using = getattr(settings, 'REPORT_UTILS_DATABASE', None)
+    max_lag = getattr(settings, 'REPORT_UTILS_REPLICA_MAX_LAG', None)
+    if using is None or using == DEFAULT_DB_ALIAS or max_lag is None:
+        return using, ''
+    lag = get_replica_lag(using)
+    if lag is None or lag <= max_lag:
+        return using, ''
+    fallback = getattr(settings, 'REPORT_UTILS_REPLICA_LAG_FALLBACK', 'primary')
+    note = 'Database {0} is {1:.0f} seconds behind.'.format(using, lag)
+    if fallback == 'raise':
+        raise ReplicaLagError(note)
+    if fallback == 'replica':
+        return using, 'Warning: {0} Data may be out of date.'.format(note)
+    return DEFAULT_DB_ALIAS, 'Warning: {0} Report read from {1}.'.format(
+        note, DEFAULT_DB_ALIAS)
+
+def iterate_queryset(queryset, stream=False, chunk_size=None):
+    """ Iterate a values() or values_list() queryset
+
+    With stream, PostgreSQL rows are fetched chunk_size at a time from a
+    server-side (named) cursor so the result is never held in memory at
+    once. Other databases fall back to .iterator(), which skips the queryset
+    cache but may still be buffered by the database driver.
+    """
+    if not stream:
+        return queryset
+    if chunk_size is None:
+        chunk_size = getattr(settings, 'REPORT_UTILS_CHUNK_SIZE', 2000)
+    if connections[queryset.db].vendor == 'postgresql':
+        return iterate_named_cursor(queryset, chunk_size)
+    return queryset.iterator()
+
+def iterate_named_cursor(queryset, chunk_size):
+    """ Stream a values() or values_list() queryset from a named psycopg2
+    cursor. Named cursors only live inside a transaction.
+    """
+    connection = connections[queryset.db]
+    with transaction.atomic(using=queryset.db):
+        cursor = connection.connection.cursor(
+            name='report_utils_{0}'.format(uuid.uuid4().hex))
+        try:
+            for row in iterate_values_cursor(queryset, cursor, chunk_size):
+                yield row
+        finally:
+            cursor.close()
+
+def iterate_values_cursor(queryset, cursor, chunk_size):
+    """ Run a values() or values_list() queryset on a DB-API cursor and
+    yield rows shaped the way the queryset itself would yield them.
+    """
+    query = queryset.query
+    compiler = query.get_compiler(queryset.db)
+    try:
+        sql, params = compiler.as_sql()
+    except EmptyResultSet:
+        return
+
+    if hasattr(query, 'values_select'):
+        field_names = list(query.values_select)
+    else:
+        # Django 1.8 compat hack.
+        field_names = list(queryset.field_names)
+    annotation_names = list(query.annotation_select)
+    # extra(select=...) cols are always at the start of the row.
+    names = list(query.extra_select) + field_names + annotation_names
+
+    if ValuesListIterable is not None:
+        as_tuple = queryset._iterable_class is ValuesListIterable
+    else:
+        as_tuple = isinstance(queryset, ValuesListQuerySet)
+    if as_tuple and queryset._fields:
+        fields = list(queryset._fields) + [
+            f for f in annotation_names if f not in queryset._fields]
+    else:
+        fields = names
+
+    cursor.execute(sql, params)
+    chunks = (
+        [row[:compiler.col_count] for row in chunk]
+        for chunk in iter(lambda: cursor.fetchmany(chunk_size), [])
+    )
+    for row in compiler.results_iter(chunks):
+        data = dict(zip(names, row))
+        if as_tuple:
+            yield tuple(data[f] for f in fields)
+        else:
+            yield data
+
 class DataExportMixin(object):
     def build_sheet(self, data, ws, sheet_name='report', header=None, widths=None):
         first_row = 1
@@ -122,6 +279,87 @@ class DataExportMixin(object):
             self.build_sheet(data, ws, header=header, widths=widths)
         return wb
 
+    def reports_to_workbook(self, sheets, user, header=None, max_workers=None,
+                            using=None, stream=False):
+        """ Run several reports concurrently and write each to its own sheet
+
+        sheets: ordered mapping of sheet name to (queryset, display_fields)
+            or (queryset, display_fields, options). options is a dict of extra
+            report_to_list arguments for that sheet (property_filters,
+            preview, chunk_size, snapshot, using, stream) and may also hold
+            the sheet's 'header'.
+        user: requesting user
+        header: header for sheets that do not set their own
+        max_workers: thread pool size.
+            Defaults to settings.REPORT_UTILS_MAX_WORKERS or 4.
+        using, stream: defaults passed on to report_to_list
+
+        Each report runs in a worker thread with its own database connection.
+        The finished sheets are written as they come in, so the total time is
+        close to that of the slowest report. If a report fails, sheets not yet
+        started are cancelled, the ones already running are waited for, and
+        ReportSheetError names the failed sheet.
+
+        Returns workbook, message in case of issues.
+        """
+        if max_workers is None:
+            max_workers = getattr(settings, 'REPORT_UTILS_MAX_WORKERS', 4)
+
+        def run_report(queryset, display_fields, options):
+            kwargs = {'using': using, 'stream': stream}
+            kwargs.update(options)
+            try:
+                return self.report_to_list(
+                    queryset, display_fields, user, **kwargs)
+            finally:
+                # Django connections are per thread; don't leak the worker's.
+                for connection in connections.all():
+                    connection.close()
+
+        wb = Workbook()
+        worksheets = {}
+        sheet_headers = {}
+        sheet_options = {}
+        for i, (sheet_name, sheet) in enumerate(sheets.items()):
+            if i > 0:
+                wb.create_sheet()
+            worksheets[sheet_name] = wb.worksheets[i]
+            options = dict(sheet[2]) if len(sheet) > 2 else {}
+            sheet_headers[sheet_name] = options.pop('header', header)
+            sheet_options[sheet_name] = options
+
+        messages = {}
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = dict(
+            (executor.submit(
+                run_report, sheet[0], sheet[1], sheet_options[sheet_name]),
+             sheet_name)
+            for sheet_name, sheet in sheets.items()
+        )
+        try:
+            for future in as_completed(futures):
+                sheet_name = futures[future]
+                try:
+                    data, messages[sheet_name] = future.result()
+                except Exception as e:
+                    raise_from(ReportSheetError(
+                        'Sheet {0} failed: {1}'.format(sheet_name, e)), e)
+                self.build_sheet(
+                    data, worksheets[sheet_name], sheet_name=sheet_name,
+                    header=sheet_headers[sheet_name])
+        finally:
+            # If a sheet failed, drop the ones not yet started and let the
+            # running ones finish so no report outlives this call.
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+        message = '\n'.join(
+            '{0}: {1}'.format(sheet_name, messages[sheet_name])
+            for sheet_name in sheets if messages.get(sheet_name)
+        )
+        return wb, message
+
     def list_to_xlsx_file(self, data, title='report', header=None, widths=None):
         """ Make 2D list into a xlsx response for download
         data can be a 2d array or a dict of 2d arrays
@@ -177,7 +415,8 @@ class DataExportMixin(object):
 
         return queryset
 
-    def report_to_list(self, queryset, display_fields, user, property_filters=[], preview=False):
+    def report_to_list(self, queryset, display_fields, user, property_filters=[], preview=False,
+                       using=None, stream=False, chunk_size=None, snapshot=None):
         """ Create list from a report with all data filtering.
 
         queryset: initial queryset to generate results
@@ -185,10 +424,45 @@ class DataExportMixin(object):
         user: requesting user
         property_filters: ???
         preview: return only first 50 rows
+        using: database alias to read from, such as a read replica.
+            Defaults to settings.REPORT_UTILS_DATABASE, then the queryset's own.
+        stream: fetch rows chunk by chunk from a server-side cursor on
+            PostgreSQL; see iterate_queryset.
+        chunk_size: rows per fetch when streaming.
+            Defaults to settings.REPORT_UTILS_CHUNK_SIZE or 2000.
+        snapshot: opt-in dict for incremental runs. Pass {} (optionally with
+            'mark_field', e.g. {'mark_field': 'updated_at'}; default 'pk')
+            and keep the dict; it is filled with the computed rows and a
+            high-water mark. Passing it back later only processes rows past
+            the mark, then re-applies sorting, formats and totals.
+
+            Rows changed below the mark are not picked up one by one. The
+            snapshot is rebuilt in full when the display fields (including
+            totals), the columns the user may see, the property filters, the
+            queryset or the number of rows at or below the mark change.
+            Rows whose mark field is NULL are included and count as below
+            the mark.
+            That covers deletions, and also edits when the mark field is
+            updated on save. With a pk mark, edits to old rows are invisible.
+            With any mark, values that don't live on the row itself stay
+            frozen: fields through a relation (author__name, m2m and reverse
+            relations), properties and custom fields. Snapshots are therefore
+            not used for reports with such columns unless the snapshot has
+            'allow_related': True. Pass a fresh {} to force a rebuild.
+            Grouped reports and previews always run in full and leave the
+            snapshot untouched.
+
+            The stored rows, totals and mark hold Decimals, dates and other
+            Python values, so persist the snapshot with pickle (e.g. the
+            Django cache or a pickled model field), not JSON.
 
         Returns list, message in case of issues.
         """
         model_class = queryset.model
+        using, routing_message = get_report_database(using)
+        if using is not None:
+            queryset = queryset.using(using)
+        db = queryset.db
 
         def can_change_or_view(model):
             """ Return True iff `user` has either change or view permission
@@ -243,8 +517,7 @@ class DataExportMixin(object):
                 if (not field.group) and (not field.aggregate):
                     field.aggregate = 'Max'
 
-        message = ""
-        objects = self.add_aggregates(queryset, display_fields)
+        message = routing_message
 
         # Display Values
 
@@ -322,12 +595,57 @@ class DataExportMixin(object):
                     display_field_paths.insert(1, '%s__pk' % property_root)
                     m2m_relations.append(property_root)
 
+        previous_snapshot = None
+        if preview or group:
+            snapshot = None
+        if (
+            snapshot is not None and not snapshot.get('allow_related') and
+            (property_list or custom_list or
+             any(df.path for df in display_fields))
+        ):
+            snapshot = None
+        if snapshot is not None:
+            mark_field = snapshot.get('mark_field') or 'pk'
+            columns = [
+                display_field_paths,
+                sorted([i, path] for i, path in property_list.items()),
+                sorted([i, path] for i, path in custom_list.items()),
+            ]
+            signature = self.get_snapshot_signature(
+                queryset, display_fields, property_filters, columns, mark_field)
+            mark = queryset.aggregate(mark=Max(mark_field))['mark']
+            old_mark = snapshot.get('mark')
+            # Rows with a NULL mark can't be placed before or after it, so
+            # they always count as old rows. A change in their number forces
+            # a full rebuild through the count check below.
+            unmarked = Q(**{mark_field + '__isnull': True})
+            if mark is not None:
+                queryset = queryset.filter(
+                    Q(**{mark_field + '__lte': mark}) | unmarked)
+            if (
+                old_mark is not None and mark is not None and
+                snapshot.get('signature') == signature and
+                snapshot.get('count') == queryset.filter(
+                    Q(**{mark_field + '__lte': old_mark}) | unmarked).count()
+            ):
+                previous_snapshot = dict(snapshot)
+                queryset = queryset.filter(**{mark_field + '__gt': old_mark})
+            snapshot.update(
+                mark_field=mark_field, signature=signature, mark=mark)
+
+        objects = self.add_aggregates(queryset, display_fields)
+
+        if previous_snapshot:
+            for key, value in previous_snapshot['totals'].items():
+                if key in display_totals:
+                    display_totals[key] += value
+
         if group:
             values = objects.values(*group)
             values = self.add_aggregates(values, display_fields)
             filtered_report_rows = [
                 [row[field] for field in display_field_paths]
-                for row in values
+                for row in iterate_queryset(values, stream, chunk_size)
             ]
             for row in filtered_report_rows:
                 for pos, field in enumerate(display_field_paths):
@@ -338,7 +656,7 @@ class DataExportMixin(object):
 
             values_list = objects.values_list(*display_field_paths)
 
-            for row in values_list:
+            for row in iterate_queryset(values_list, stream, chunk_size):
                 row = list(row)
                 values_and_properties_list.append(row[1:])
                 obj = None # we will get this only if needed for more complex processing
@@ -347,13 +665,13 @@ class DataExportMixin(object):
                 # filter properties (remove rows with excluded properties)
                 for property_filter in property_filters:
                     if not obj:
-                        obj = model_class.objects.get(pk=row.pop(0))
+                        obj = model_class.objects.using(db).get(pk=row.pop(0))
                     root_relation = property_filter.path.split('__')[0]
                     if root_relation in m2m_relations:
                         pk = row[0]
                         if pk is not None:
                             # a related object exists
-                            m2m_obj = getattr(obj, root_relation).get(pk=pk)
+                            m2m_obj = getattr(obj, root_relation).using(db).get(pk=pk)
                             val = reduce(getattr, [property_filter.field], m2m_obj)
                         else:
                             val = None
@@ -362,7 +680,8 @@ class DataExportMixin(object):
                             for relation in property_filter.path.split('__'):
                                 if hasattr(obj, root_relation):
                                     obj = getattr(obj, root_relation)
-                            val = obj.get_custom_value(property_filter.field)
+                            val = get_custom_value_from_object(
+                                obj, property_filter.field, using=db)
                         else:
                             val = reduce(getattr, (property_filter.path + property_filter.field).split('__'), obj)
                     if property_filter.filter_property(val):
@@ -370,19 +689,21 @@ class DataExportMixin(object):
                         values_and_properties_list.pop()
                         break
                 if not remove_row:
+                    # row may have lost its pk to a property filter above,
+                    # so read values from the copy taken before that.
                     for i, field in enumerate(display_field_paths[1:]):
-                        increment_total(field, row[i + 1])
+                        increment_total(field, values_and_properties_list[-1][i])
 
                     for position, display_property in property_list.items():
                         if not obj:
-                            obj = model_class.objects.get(pk=row.pop(0))
+                            obj = model_class.objects.using(db).get(pk=row.pop(0))
                         relations = display_property.split('__')
                         root_relation = relations[0]
                         if root_relation in m2m_relations:
                             pk = row.pop(0)
                             if pk is not None:
                                 # a related object exists
-                                m2m_obj = getattr(obj, root_relation).get(pk=pk)
+                                m2m_obj = getattr(obj, root_relation).using(db).get(pk=pk)
                                 val = reduce(getattr, relations[1:], m2m_obj)
                             else:
                                 val = None
@@ -397,8 +718,9 @@ class DataExportMixin(object):
 
                     for position, display_custom in custom_list.items():
                         if not obj:
-                            obj = model_class.objects.get(pk=row.pop(0))
-                        val = obj.get_custom_value(display_custom)
+                            obj = model_class.objects.using(db).get(pk=row.pop(0))
+                        val = get_custom_value_from_object(
+                            obj, display_custom, using=db)
                         values_and_properties_list[-1].insert(position, val)
                         increment_total(display_custom, val)
 
@@ -407,6 +729,18 @@ class DataExportMixin(object):
                 if preview and len(filtered_report_rows) == 50:
                     break
 
+            if snapshot is not None:
+                count = queryset.count()
+                if previous_snapshot:
+                    filtered_report_rows = (
+                        previous_snapshot['rows'] + filtered_report_rows)
+                    count += previous_snapshot['count']
+                snapshot.update(
+                    rows=list(filtered_report_rows),
+                    totals=dict(display_totals),
+                    count=count,
+                )
+
         # Sort results if requested.
 
         if hasattr(display_fields, 'filter'):
@@ -511,6 +845,38 @@ class DataExportMixin(object):
 
         return values_and_properties_list, message
 
+    def get_snapshot_signature(self, queryset, display_fields, property_filters,
+                               columns, mark_field):
+        """ Identify a report definition so a stale snapshot is not reused
+
+        columns are the value, property and custom field columns left after
+        permission checks, so users who see different columns don't share rows.
+        """
+        def describe(obj):
+            try:
+                items = vars(obj).items()
+            except TypeError:
+                return text_type(obj)
+            return sorted(
+                [key, text_type(value)] for key, value in items
+                if not key.startswith('_'))
+
+        try:
+            query = text_type(queryset.query)
+        except Exception:
+            query = None
+        fields = [
+            [df.path, df.field, df.aggregate, df.field_type, bool(df.total)]
+            for df in display_fields
+        ]
+        return {
+            'query': query,
+            'fields': fields,
+            'property_filters': [describe(pf) for pf in property_filters],
+            'columns': columns,
+            'mark_field': mark_field,
+        }
+
     def sort_helper(self, value, default):
         if value is None:
             value = default
@@ -611,3 +977,126 @@ class GetFieldsMixin(object):
         model_ct = ContentType.objects.get_for_model(new_model)
 
         return (new_fields, model_ct, path)
+
+    def get_field_tree(self, model_class, depth=2, path='', path_verbose=''):
+        """ Build the full field tree reachable from a model in one pass
+
+        Each model is introspected once per call no matter how many times it
+        is reached, so a whole tree costs about as much as expanding each
+        distinct model by hand.
+
+        :param model_class: A django model class to use as the root
+        :param depth: How many levels of relations to expand. Relations
+            beyond this depth are listed but not expanded; expand them
+            later with expand_field_tree.
+        :param path: path of the root in format field_name__second_field__
+        :param path_verbose: Human readable version of above
+        :returns: A dict of plain values (see field_tree_to_json)
+            root: the root node. A node has the model, path, path_verbose
+                and relations; each relation has its own path, the model it
+                points to and either a child node or None if unexpanded.
+            models: fields, properties, custom fields and app label of every
+                model referenced by a node or relation, stored once and
+                keyed by the content type id as a string, so the tree
+                looks the same before and after a JSON round trip.
+        :rtype: dict
+        """
+        cache = {}
+        root = self._build_field_tree(
+            model_class, depth, path, path_verbose, (), cache)
+        models = {}
+        for description in cache.values():
+            models[description['_key']] = dict(
+                (key, value) for key, value in description.items()
+                if not key.startswith('_'))
+        return {'root': root, 'models': models}
+
+    def expand_field_tree(self, root_model, path, depth=2, path_verbose=''):
+        """ Build the field tree for a relation left unexpanded by
+        get_field_tree.
+
+        :param root_model: The root model class of the report
+        :param path: path of the relation in format field_name__second_field__
+        :param depth: How many levels of relations to expand from there
+        :param path_verbose: Human readable version of path
+        """
+        model_class = get_model_from_path_string(root_model, path)
+        return self.get_field_tree(
+            model_class, depth=depth, path=path, path_verbose=path_verbose)
+
+    def field_tree_to_json(self, tree):
+        """ Serialize a field tree to a compact JSON string for caching """
+        return json.dumps(tree, separators=(',', ':'), sort_keys=True)
+
+    def _describe_model(self, model_class, cache):
+        """ Introspect a single model for the field tree, memoized in cache """
+        if model_class in cache:
+            return cache[model_class]
+
+        fields = [{
+            'name': field.name,
+            'verbose_name': text_type(getattr(field, 'verbose_name', field.name)),
+            'field_type': field.get_internal_type(),
+            'choices': bool(getattr(field, 'choices', None)),
+        } for field in get_direct_fields_from_model(model_class)]
+
+        custom_fields = [{
+            'id': custom_field.pk,
+            'name': custom_field.name,
+        } for custom_field in get_custom_fields_from_model(model_class) or []]
+
+        relations = []
+        for field in get_relation_fields_from_model(model_class):
+            relations.append((
+                field.field_name,
+                field.name,
+                get_model_from_path_string(model_class, field.field_name),
+            ))
+
+        model_ct = ContentType.objects.get_for_model(model_class)
+        cache[model_class] = description = {
+            'model': model_ct.model,
+            'app_label': model_class._meta.app_label,
+            'content_type_id': model_ct.pk,
+            '_key': text_type(model_ct.pk),
+            'fields': fields,
+            'properties': get_properties_from_model(model_class),
+            'custom_fields': custom_fields,
+            '_relations': relations,
+        }
+        return description
+
+    def _build_field_tree(self, model_class, depth, path, path_verbose,
+                          ancestors, cache):
+        description = self._describe_model(model_class, cache)
+        ancestors = ancestors + (model_class,)
+
+        relations = []
+        for field_name, name, related_model in description['_relations']:
+            relation_path = path + field_name + '__'
+            relation_path_verbose = path_verbose + '::' + name if path_verbose else name
+            # A model already on this branch would expand forever, so stop
+            # there and leave it for lazy expansion like any other leaf.
+            cycle = related_model in ancestors
+            relation = {
+                'field_name': field_name,
+                'name': name,
+                'path': relation_path,
+                'path_verbose': relation_path_verbose,
+                'model': self._describe_model(
+                    related_model, cache)['_key'],
+                'cycle': cycle,
+                'children': None,
+            }
+            if depth > 0 and not cycle:
+                relation['children'] = self._build_field_tree(
+                    related_model, depth - 1, relation_path,
+                    relation_path_verbose, ancestors, cache)
+            relations.append(relation)
+
+        return {
+            'model': description['_key'],
+            'path': path,
+            'path_verbose': path_verbose,
+            'relations': relations,
+        }
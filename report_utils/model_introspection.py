@@ -2,6 +2,7 @@
 from django.contrib.contenttypes.models import ContentType
 from django.db.models.fields import FieldDoesNotExist
 from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
 import inspect
 
 def isprop(v):
@@ -60,6 +61,26 @@ def get_custom_fields_from_model(model_class):
         return custom_fields
 
 
+def get_custom_value_from_object(obj, field_name, using=None):
+    """ Read a django-custom-fields value for an object from database `using`
+
+    On the default database this is just obj.get_custom_value. Elsewhere
+    (such as a read replica) the value is read without get_or_create, so
+    nothing is written; a missing value gives the field's default instead.
+    """
+    if using is None or using == DEFAULT_DB_ALIAS:
+        return obj.get_custom_value(field_name)
+    from custom_field.models import CustomField, CustomFieldValue
+    content_type = ContentType.objects.db_manager(using).get_for_model(obj)
+    field = CustomField.objects.using(using).get(
+        content_type=content_type, name=field_name)
+    values = CustomFieldValue.objects.using(using).filter(
+        field=field, object_id=obj.pk).values_list('value', flat=True)[:1]
+    if values:
+        return values[0]
+    return getattr(field, 'default_value', None)
+
+
 def get_model_from_path_string(root_model, path):
     """ Return a model class for a related model
     root_model is the class of the initial model
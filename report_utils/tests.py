@@ -0,0 +1,368 @@
+from collections import OrderedDict
+import datetime
+import json
+import pickle
+
+from django.contrib.auth.models import Group, Permission, User
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.db.models import Max
+from django.test import TestCase, TransactionTestCase, override_settings
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from report_utils.mixins import (
+    DataExportMixin,
+    DisplayField,
+    GetFieldsMixin,
+    ReplicaLagError,
+    ReportSheetError,
+    get_report_database,
+    iterate_values_cursor,
+)
+
+
+class StreamingTests(TestCase):
+    def setUp(self):
+        for name in ('alice', 'bob', 'carol'):
+            User.objects.create_user(name)
+
+    def stream(self, queryset):
+        return list(iterate_values_cursor(queryset, connection.cursor(), 2))
+
+    def test_values_list_rows_match_queryset(self):
+        queryset = User.objects.annotate(Max('id')).values_list(
+            'id__max', 'username')
+
+        self.assertEqual(self.stream(queryset), list(queryset))
+
+    def test_values_rows_match_queryset(self):
+        queryset = User.objects.values('username').annotate(Max('id'))
+
+        self.assertEqual(self.stream(queryset), list(queryset))
+
+    def test_empty_result(self):
+        queryset = User.objects.filter(pk__in=[]).values_list('username')
+
+        self.assertEqual(self.stream(queryset), [])
+
+
+@override_settings(
+    REPORT_UTILS_DATABASE='replica', REPORT_UTILS_REPLICA_MAX_LAG=60)
+@mock.patch('report_utils.mixins.get_replica_lag', return_value=120)
+class ReplicaRoutingTests(TestCase):
+    def test_caught_up_replica_is_used(self, get_replica_lag):
+        get_replica_lag.return_value = 0
+
+        self.assertEqual(get_report_database(), ('replica', ''))
+
+    def test_lagging_replica_falls_back_to_primary(self, get_replica_lag):
+        using, message = get_report_database()
+
+        self.assertEqual(using, 'default')
+        self.assertIn('120 seconds behind', message)
+
+    @override_settings(REPORT_UTILS_REPLICA_LAG_FALLBACK='replica')
+    def test_lagging_replica_used_anyway(self, get_replica_lag):
+        using, message = get_report_database()
+
+        self.assertEqual(using, 'replica')
+        self.assertIn('out of date', message)
+
+    @override_settings(REPORT_UTILS_REPLICA_LAG_FALLBACK='raise')
+    def test_lagging_replica_raises(self, get_replica_lag):
+        self.assertRaises(ReplicaLagError, get_report_database)
+
+
+class NamedDisplayField(DisplayField):
+    """ DisplayField with the name report builder's model provides """
+    @property
+    def name(self):
+        return self.field
+
+
+class UsernameFilter(object):
+    """ Minimal stand-in for a report builder property filter """
+    field_type = ''
+
+    def __init__(self, excluded):
+        self.path = ''
+        self.field = 'username'
+        self.excluded = excluded
+
+    def filter_property(self, value):
+        return value == self.excluded
+
+
+class ReportSnapshotTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'pass')
+        self.queryset = User.objects.filter(is_superuser=False)
+        for name in ('alice', 'bob', 'carol'):
+            User.objects.create_user(name, name + '@example.com')
+        self.mixin = DataExportMixin()
+
+    def run_report(self, snapshot, display_fields=None, user=None,
+                   property_filters=[]):
+        if display_fields is None:
+            display_fields = ['username']
+        rows, message = self.mixin.report_to_list(
+            self.queryset, display_fields, user or self.admin,
+            property_filters=property_filters, snapshot=snapshot)
+        return rows
+
+    def usernames(self, rows):
+        return sorted(row[0] for row in rows)
+
+    def mark_stale(self, snapshot):
+        """ Tamper with a stored row so reusing it shows in the output """
+        snapshot['rows'][0][0] = 'stale'
+
+    def test_append_processes_only_new_rows(self):
+        snapshot = {}
+        self.run_report(snapshot)
+        self.mark_stale(snapshot)
+        User.objects.create_user('dave')
+
+        rows = self.run_report(snapshot)
+
+        self.assertEqual(self.usernames(rows), ['bob', 'carol', 'dave', 'stale'])
+        self.assertEqual(snapshot['count'], 4)
+
+    def test_pickled_snapshot_is_reused(self):
+        snapshot = {}
+        self.run_report(snapshot)
+        self.mark_stale(snapshot)
+        snapshot = pickle.loads(pickle.dumps(snapshot))
+        User.objects.create_user('dave')
+
+        rows = self.run_report(snapshot)
+
+        self.assertEqual(self.usernames(rows), ['bob', 'carol', 'dave', 'stale'])
+
+    def test_related_columns_skip_snapshot(self):
+        snapshot = {}
+
+        rows = self.run_report(snapshot, ['username', 'groups__name'])
+
+        self.assertEqual(snapshot, {})
+        self.assertEqual(self.usernames(rows), ['alice', 'bob', 'carol'])
+
+    def test_related_columns_allowed_by_opt_in(self):
+        snapshot = {'allow_related': True}
+
+        self.run_report(snapshot, ['username', 'groups__name'])
+
+        self.assertEqual(len(snapshot['rows']), 3)
+
+    def test_totals_merge(self):
+        display_fields = (
+            DisplayField('', '', 'id', '', '', True, None, None, ''),
+        )
+        snapshot = {}
+        self.run_report(snapshot, display_fields)
+        User.objects.create_user('dave')
+
+        rows = self.run_report(snapshot, display_fields)
+
+        expected = sum(self.queryset.values_list('id', flat=True))
+        self.assertEqual(rows[-2], ['TOTALS'])
+        self.assertEqual(rows[-1], [expected])
+
+    def test_delete_below_mark_rebuilds(self):
+        snapshot = {}
+        self.run_report(snapshot)
+        self.mark_stale(snapshot)
+        User.objects.get(username='bob').delete()
+
+        rows = self.run_report(snapshot)
+
+        self.assertEqual(self.usernames(rows), ['alice', 'carol'])
+
+    def test_edit_below_updated_at_mark_rebuilds(self):
+        snapshot = {'mark_field': 'date_joined'}
+        self.run_report(snapshot)
+        self.mark_stale(snapshot)
+        user = User.objects.get(username='bob')
+        user.username = 'robert'
+        user.date_joined += datetime.timedelta(days=1)
+        user.save()
+
+        rows = self.run_report(snapshot)
+
+        self.assertEqual(self.usernames(rows), ['alice', 'carol', 'robert'])
+
+    def test_null_mark_rows_are_included(self):
+        User.objects.filter(username='alice').update(
+            last_login=datetime.datetime(2000, 1, 1))
+        snapshot = {'mark_field': 'last_login'}
+
+        rows = self.run_report(snapshot)
+
+        self.assertEqual(self.usernames(rows), ['alice', 'bob', 'carol'])
+
+    def test_signature_change_rebuilds(self):
+        viewer = User.objects.create_user('viewer', is_staff=True)
+        viewer.user_permissions.add(
+            Permission.objects.get(codename='change_user'))
+        self.queryset = self.queryset.exclude(username='viewer')
+
+        permission_fields = (
+            NamedDisplayField('', '', 'username', '', '', None, None, None, ''),
+            NamedDisplayField(
+                'groups__', '', 'name', '', '', None, None, None, ''),
+        )
+        changes = [
+            ({}, dict(property_filters=[UsernameFilter('bob')])),
+            ({}, dict(display_fields=(
+                DisplayField('', '', 'username', '', '', True, None, None, ''),
+            ))),
+            (
+                dict(display_fields=permission_fields),
+                dict(display_fields=permission_fields, user=viewer),
+            ),
+        ]
+        for before, after in changes:
+            snapshot = {'allow_related': True}
+            self.run_report(snapshot, **before)
+            self.mark_stale(snapshot)
+
+            rows = self.run_report(snapshot, **after)
+
+            self.assertNotIn('stale', [row[0] for row in rows], after)
+
+
+class FieldTreeTests(TestCase):
+    def setUp(self):
+        self.mixin = GetFieldsMixin()
+
+    def relations(self, node):
+        return dict(
+            (relation['field_name'], relation) for relation in node['relations'])
+
+    def model_key(self, model_class):
+        return str(ContentType.objects.get_for_model(model_class).pk)
+
+    def test_depth_cut_off(self):
+        tree = self.mixin.get_field_tree(User, depth=1)
+
+        groups = self.relations(tree['root'])['groups']
+        self.assertEqual(groups['path'], 'groups__')
+        permissions = self.relations(groups['children'])['permissions']
+        self.assertIsNone(permissions['children'])
+        self.assertFalse(permissions['cycle'])
+        self.assertEqual(permissions['model'], self.model_key(Permission))
+
+    def test_cycle_back_to_ancestor(self):
+        tree = self.mixin.get_field_tree(User, depth=5)
+
+        groups = self.relations(tree['root'])['groups']
+        user = self.relations(groups['children'])['user']
+        self.assertTrue(user['cycle'])
+        self.assertIsNone(user['children'])
+        self.assertEqual(user['path'], 'groups__user__')
+        self.assertEqual(user['model'], self.model_key(User))
+
+    def test_models_are_stored_once(self):
+        tree = self.mixin.get_field_tree(User, depth=2)
+
+        self.assertEqual(
+            sorted(tree['models']),
+            sorted(self.model_key(model) for model in (
+                User, Group, Permission, ContentType)))
+        self.assertNotIn('fields', tree['root'])
+        user = tree['models'][tree['root']['model']]
+        self.assertEqual(user['model'], 'user')
+        self.assertIn('username', [field['name'] for field in user['fields']])
+
+    def test_expand_unexpanded_path(self):
+        tree = self.mixin.get_field_tree(User, depth=0)
+        groups = self.relations(tree['root'])['groups']
+        self.assertIsNone(groups['children'])
+
+        expanded = self.mixin.expand_field_tree(
+            User, groups['path'], depth=0, path_verbose=groups['path_verbose'])
+
+        self.assertEqual(expanded['root']['model'], groups['model'])
+        self.assertEqual(expanded['root']['path'], 'groups__')
+        permissions = self.relations(expanded['root'])['permissions']
+        self.assertEqual(permissions['path'], 'groups__permissions__')
+
+    def test_json_round_trip(self):
+        tree = self.mixin.get_field_tree(User, depth=2)
+
+        cached = json.loads(self.mixin.field_tree_to_json(tree))
+
+        self.assertEqual(cached, tree)
+        self.assertIn(cached['root']['model'], cached['models'])
+
+
+class ReportsToWorkbookTests(TransactionTestCase):
+    """ Sheets run on worker threads with their own connections, so the
+    data has to be committed.
+    """
+    def setUp(self):
+        self.admin = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'pass')
+        for name in ('alice', 'bob'):
+            User.objects.create_user(name)
+        for name in ('staff', 'sales'):
+            Group.objects.create(name=name)
+        self.mixin = DataExportMixin()
+
+    def values(self, ws):
+        return [[cell.value for cell in row] for row in ws.rows]
+
+    def test_sheets_keep_mapping_order(self):
+        users = User.objects.order_by('username')
+        groups = Group.objects.order_by('name')
+        wb, message = self.mixin.reports_to_workbook(OrderedDict([
+            ('users', (users, ['username'])),
+            ('groups', (groups, ['name'])),
+            ('more_users', (users, ['username'])),
+        ]), self.admin, max_workers=3)
+
+        self.assertEqual(
+            [ws.title for ws in wb.worksheets],
+            ['users', 'groups', 'more_users'])
+        self.assertEqual(
+            self.values(wb.worksheets[1]), [['sales'], ['staff']])
+        self.assertEqual(message, '')
+
+    def test_per_sheet_header_and_options(self):
+        users = User.objects.order_by('username')
+        wb, message = self.mixin.reports_to_workbook(OrderedDict([
+            ('filtered', (users, ['username'], {
+                'header': ['Name'],
+                'property_filters': [UsernameFilter('bob')],
+            })),
+            ('plain', (users, ['username'])),
+        ]), self.admin, header=['Default'])
+
+        self.assertEqual(
+            self.values(wb.worksheets[0]), [['Name'], ['admin'], ['alice']])
+        self.assertEqual(
+            self.values(wb.worksheets[1]),
+            [['Default'], ['admin'], ['alice'], ['bob']])
+
+    def test_messages_are_joined_per_sheet(self):
+        nobody = User.objects.get(username='alice')
+        wb, message = self.mixin.reports_to_workbook(OrderedDict([
+            ('users', (User.objects.all(), ['username'])),
+            ('groups', (Group.objects.all(), ['name'])),
+        ]), nobody)
+
+        self.assertEqual(
+            message, 'users: Permission Denied\ngroups: Permission Denied')
+
+    def test_failed_sheet_is_named(self):
+        with self.assertRaises(ReportSheetError) as raised:
+            self.mixin.reports_to_workbook(OrderedDict([
+                ('users', (User.objects.all(), ['username'])),
+                ('broken', (User.objects.all(), ['no_such_field'])),
+            ]), self.admin)
+
+        self.assertIn('Sheet broken failed', str(raised.exception))
@@ -27,5 +27,6 @@ setup(
     install_requires=[
         'django',
         'six',
+        'futures; python_version < "3"',
     ]
 )